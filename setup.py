@@ -24,6 +24,7 @@ setup(
     author_email="",
     python_requires=">=3",
     install_requires=["omero-py>=5.6.0", "ome-zarr"],
+    extras_require={"numba": ["numba"]},
     keywords=["OMERO.CLI", "plugin"],
     url="https://github.com/ome/omero-cli-zarr/",
     setup_requires=["setuptools_scm"],
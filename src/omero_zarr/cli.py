@@ -118,11 +118,12 @@ class ZarrControl(BaseControl):
         )
         masks.add_argument(
             "--label-bits",
-            default=str(max(MASK_DTYPE_SIZE.keys())),
+            default=None,
             choices=[str(s) for s in sorted(MASK_DTYPE_SIZE.keys())],
             help=(
                 "Integer bit size for each label pixel, use 1 for a binary "
-                "label, default %(default)s"
+                "label. By default, the smallest size which holds a label "
+                "for every ROI"
             ),
         )
         masks.add_argument(
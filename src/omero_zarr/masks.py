@@ -1,12 +1,13 @@
 import argparse
+import os
 from collections import defaultdict
-from fileinput import input
-from typing import Dict, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Set, Tuple
 
 import numpy as np
 import omero.clients  # noqa
 from ome_zarr.conversions import int_to_rgba_255
-from ome_zarr.data import write_multiscale
 from ome_zarr.io import parse_url
 from ome_zarr.reader import Multiscales, Node
 from ome_zarr.scale import Scaler
@@ -14,6 +15,12 @@ from ome_zarr.types import JSONDict
 from omero.model import MaskI
 from omero.rtypes import unwrap
 from zarr.convenience import open as zarr_open
+from zarr.hierarchy import Group
+
+try:
+    from numba import from_dtype, njit, types
+except ImportError:  # pragma: no cover
+    njit = None  # type: ignore
 
 # Mapping of dimension names to axes in the Zarr
 DIMENSION_ORDER: Dict[str, int] = {
@@ -24,8 +31,14 @@ DIMENSION_ORDER: Dict[str, int] = {
     "X": 4,
 }
 
+# Bounds of the Y/X chunk size of the label arrays, in pixels
+CHUNK_SIZE_MIN = 256
+CHUNK_SIZE_MAX = 512
+
+# Label dtypes for --label-bits. Boolean labels need no packed-bit path of
+# their own: the paint kernel sets them straight from the packed mask bytes
 MASK_DTYPE_SIZE: Dict[int, np.dtype] = {
-    1: np.bool,
+    1: np.bool_,
     8: np.int8,
     16: np.int16,
     32: np.int32,
@@ -33,6 +46,81 @@ MASK_DTYPE_SIZE: Dict[int, np.dtype] = {
 }
 
 
+def _paint_masks(
+    labels: np.ndarray,
+    packed: np.ndarray,
+    offsets: np.ndarray,
+    meta: np.ndarray,
+    check_overlaps: bool,
+) -> int:
+    """
+    Unpacks and paints the masks into `labels` in one pass over their bytes,
+    without materializing the unpacked masks.
+
+    :param labels: 5D label array (T, C, Z, Y, X) to paint into
+    :param packed: concatenated packed mask bytes of all the masks
+    :param offsets: start of each mask in `packed`
+    :param meta: one row per mask of
+        (t0, t1, c0, c1, z0, z1, y, x, h, w, label) where the t/c/z pairs
+        are the (start, stop) planes the mask is copied to
+    :param check_overlaps: Whether to check for overlapping masks or not
+    :return: index of the first mask which overlaps existing labels, or -1
+    """
+    for i in range(meta.shape[0]):
+        t0, t1 = meta[i, 0], meta[i, 1]
+        c0, c1 = meta[i, 2], meta[i, 3]
+        z0, z1 = meta[i, 4], meta[i, 5]
+        y, x, h, w, label = meta[i, 6], meta[i, 7], meta[i, 8], meta[i, 9], meta[i, 10]
+        n_bits = h * w
+        start = offsets[i]
+        # One plane at a time so that the writes stay within a plane
+        for i_t in range(t0, t1):
+            for i_c in range(c0, c1):
+                for i_z in range(z0, z1):
+                    plane = labels[i_t, i_c, i_z]
+                    # The bits run along the rows of the mask without row
+                    # padding: follow the pixel position as they are read
+                    row = y
+                    col = x
+                    for b in range((n_bits + 7) // 8):
+                        byte = packed[start + b]
+                        if byte == 0:
+                            # Skip 8 background pixels at once, common in
+                            # sparse masks
+                            col += 8
+                            while col >= x + w:
+                                col -= w
+                                row += 1
+                            continue
+                        for k in range(min(8, n_bits - b * 8)):
+                            if byte & (0x80 >> k):
+                                if check_overlaps and plane[row, col]:
+                                    return i
+                                plane[row, col] = label
+                            col += 1
+                            if col == x + w:
+                                col = x
+                                row += 1
+    return -1
+
+
+@lru_cache(maxsize=None)
+def _get_paint_kernel(label_dtype: np.dtype) -> Callable[..., int]:
+    """
+    Compiles _paint_masks with numba for labels of `label_dtype`. The
+    explicit signature compiles eagerly, once per dtype, and skips type
+    dispatch on every call.
+    """
+    signature = types.int64(
+        types.Array(from_dtype(np.dtype(label_dtype)), 5, "C"),
+        types.Array(types.uint8, 1, "C"),
+        types.Array(types.int64, 1, "C"),
+        types.Array(types.int64, 2, "C"),
+        types.boolean,
+    )
+    return njit(signature, cache=True, boundscheck=False)(_paint_masks)
+
+
 def image_masks_to_zarr(
     image: omero.gateway.ImageWrapper, args: argparse.Namespace
 ) -> None:
@@ -55,11 +143,12 @@ def image_masks_to_zarr(
 
     print(f"Found {shape_count} mask shapes in {len(masks)} ROIs")
 
-    dtype = MASK_DTYPE_SIZE[int(args.label_bits)]
+    # None lets MaskSaver pick the smallest type which holds every label
+    dtype = MASK_DTYPE_SIZE[int(args.label_bits)] if args.label_bits else None
 
     if args.style == "labeled" and args.label_bits == "1":
-        print("Boolean type makes no sense for labeled. Using 64")
-        dtype = MASK_DTYPE_SIZE[64]
+        print("Boolean type makes no sense for labeled. Using the default")
+        dtype = None
 
     if masks:
 
@@ -72,16 +161,12 @@ def image_masks_to_zarr(
             if args.label_map:
 
                 label_map = defaultdict(list)
-                roi_map = {}
-                for (roi_id, roi) in masks.items():
-                    roi_map[roi_id] = roi
-
                 try:
-                    for line in input(args.label_map):
-                        line = line.strip()
-                        sid, name, roi = line.split(",")
-                        label_map[name].append(roi_map[int(roi)])
-                except Exception as e:
+                    with open(args.label_map) as fh:
+                        for line in fh:
+                            sid, name, roi = line.strip().split(",")
+                            label_map[name].append(masks[int(roi)])
+                except (OSError, ValueError, KeyError) as e:
                     print(f"Error parsing {args.label_map}: {e}")
 
                 for name, values in label_map.items():
@@ -89,6 +174,7 @@ def image_masks_to_zarr(
                     saver.save(values, name)
             else:
                 saver.save(list(masks.values()), args.label_name)
+        saver.clear_cache()
     else:
         print("No masks found on Image")
 
@@ -99,10 +185,16 @@ class MaskSaver:
     masks to zarr groups/arrays.
     """
 
+    # Row b holds the 8 bits of the byte value b (most significant first), so
+    # that unpacking a mask is a single gather
+    _UNPACK_LUT: np.ndarray = np.unpackbits(
+        np.arange(256, dtype=np.uint8)[:, None], axis=1
+    ).astype(bool)
+
     def __init__(
         self,
         image: omero.gateway.ImageWrapper,
-        dtype: np.dtype,
+        dtype: np.dtype = None,
         path: str = "labels",
         style: str = "labeled",
         source: str = "..",
@@ -124,48 +216,66 @@ class MaskSaver:
             self.size_y,
             self.size_x,
         )
-
-    def save(self, masks: List[omero.model.Shape], name: str) -> None:
-
-        # Figure out whether we can flatten some dimensions
-        unique_dims: Dict[str, Set[int]] = {
-            "T": {unwrap(mask.theT) for shapes in masks for mask in shapes},
-            "C": {unwrap(mask.theC) for shapes in masks for mask in shapes},
-            "Z": {unwrap(mask.theZ) for shapes in masks for mask in shapes},
-        }
-        ignored_dimensions: Set[str] = set()
-        print(f"Unique dimensions: {unique_dims}")
-
-        for d in "TCZ":
-            if unique_dims[d] == {None}:
-                ignored_dimensions.add(d)
-
-        filename = f"{self.image.id}.zarr"
+        self.filename = f"{image.id}.zarr"
+        # Set by _open_labels() on the first save() and reused afterwards
+        self._out_labels: Group = None
+        self._label_names: List[str] = []
+        self._input_pyramid_levels = 0
+        self._source_image_link = source
+        self._shape_cache: Dict[int, Tuple[Tuple[int, ...], np.ndarray]] = {}
+
+    def _open_labels(self) -> Group:
+        """
+        Verifies the source image and opens (or creates) the labels group,
+        only once for all the calls to save()
+        """
+        if self._out_labels is not None:
+            return self._out_labels
 
         # Verify that we are linking this mask to a real ome-zarr
         source_image = self.source_image
-        source_image_link = self.source_image
         if source_image is None:
             # Assume that we're using the output directory
-            source_image = filename
-            source_image_link = "../.."  # Drop "labels/0"
+            source_image = self.filename
+            self._source_image_link = "../.."  # Drop "labels/0"
 
         src = parse_url(source_image)
         assert src, "Source image does not exist"
         input_pyramid = Node(src, [])
         assert input_pyramid.load(Multiscales), "No multiscales metadata found"
-        input_pyramid_levels = len(input_pyramid.data)
+        self._input_pyramid_levels = len(input_pyramid.data)
 
-        root = zarr_open(filename)
+        root = zarr_open(self.filename)
         if self.path in root.group_keys():
             out_labels = getattr(root, self.path)
         else:
             out_labels = root.create_group(self.path)
+        # TODO: could temporarily support "masks" here as well
+        self._label_names = list(out_labels.attrs.get("labels", []))
+        self._out_labels = out_labels
+        return out_labels
+
+    def save(self, masks: List[omero.model.Shape], name: str) -> None:
+
+        # Figure out whether we can flatten some dimensions
+        shape_arrays = self._extract_shape_arrays(masks)
+        unique_dims: Dict[str, Set[int]] = {
+            d: {None if v < 0 else v for v in np.unique(shape_arrays[d]).tolist()}
+            for d in "TCZ"
+        }
+        ignored_dimensions: Set[str] = set()
+        print(f"Unique dimensions: {unique_dims}")
+
+        for d in "TCZ":
+            if unique_dims[d] == {None}:
+                ignored_dimensions.add(d)
+
+        out_labels = self._open_labels()
 
         _mask_shape: List[int] = list(self.image_shape)
         for d in ignored_dimensions:
             _mask_shape[DIMENSION_ORDER[d]] = 1
-            mask_shape: Tuple[int, ...] = tuple(_mask_shape)
+        mask_shape: Tuple[int, ...] = tuple(_mask_shape)
         del _mask_shape
         print(f"Ignoring dimensions {ignored_dimensions}")
 
@@ -174,19 +284,30 @@ class MaskSaver:
 
         # Create and store binary data
         labels, fill_colors = self.masks_to_labels(
-            masks, mask_shape, ignored_dimensions, check_overlaps=True,
+            masks,
+            mask_shape,
+            ignored_dimensions,
+            check_overlaps=True,
+            shape_arrays=shape_arrays,
         )
-        scaler = Scaler(max_layer=input_pyramid_levels)
+        scaler = Scaler(max_layer=self._input_pyramid_levels)
         label_pyramid = scaler.nearest(labels)
         pyramid_grp = out_labels.create_group(name)
-        write_multiscale(label_pyramid, pyramid_grp)  # TODO: dtype, chunks, overwite
+        # write_multiscale does not take chunks, so write the levels and the
+        # same multiscales metadata here. TODO: overwrite
+        chunks = self._get_chunks(shape_arrays)
+        datasets: List[JSONDict] = []
+        for path, level in enumerate(label_pyramid):
+            self._write_level(pyramid_grp, str(path), level, chunks)
+            datasets.append({"path": str(path)})
+        pyramid_grp.attrs["multiscales"] = [{"version": "0.1", "datasets": datasets}]
 
         # Specify and store metadata
         image_label_colors: List[JSONDict] = []
         image_label = {
             "version": "0.1",
             "colors": image_label_colors,
-            "source": {"image": source_image_link},
+            "source": {"image": self._source_image_link},
         }
         if fill_colors:
             for label_value, rgba_int in sorted(fill_colors.items()):
@@ -197,59 +318,170 @@ class MaskSaver:
         pyramid_grp.attrs["image-label"] = image_label
 
         # Register with labels metadata
-        print(f"Created {filename}/{self.path}/{name}")
-        attrs = out_labels.attrs.asdict()
-        # TODO: could temporarily support "masks" here as well
-        if "labels" in attrs:
-            if name not in attrs["labels"]:
-                attrs["labels"].append(name)
-        else:
-            attrs["labels"] = [name]
-        out_labels.attrs.update(attrs)
+        print(f"Created {self.filename}/{self.path}/{name}")
+        if name not in self._label_names:
+            self._label_names.append(name)
+            out_labels.attrs["labels"] = self._label_names
 
-    def _mask_to_binim_yx(
-        self, mask: omero.model.Shape
-    ) -> Tuple[np.ndarray, Tuple[int, ...]]:
+    def _get_chunks(self, shape_arrays: Dict[str, Any]) -> Tuple[int, ...]:
         """
-        :param mask MaskI: An OMERO mask
+        Chunks of one (Y, X) tile per plane, sized to a few times the median
+        mask so that a chunk covers a handful of masks rather than the whole
+        plane
+        """
+        if shape_arrays["H"].size == 0:
+            return (1, 1, 1, self.size_y, self.size_x)
+        med_h = int(np.median(shape_arrays["H"]))
+        med_w = int(np.median(shape_arrays["W"]))
+        chunk_y = min(max(med_h * 4, CHUNK_SIZE_MIN), CHUNK_SIZE_MAX)
+        chunk_x = min(max(med_w * 4, CHUNK_SIZE_MIN), CHUNK_SIZE_MAX)
+        return (1, 1, 1, min(chunk_y, self.size_y), min(chunk_x, self.size_x))
+
+    def _write_level(
+        self, group: Group, path: str, level: np.ndarray, chunks: Tuple[int, ...]
+    ) -> None:
+        """
+        Writes one pyramid level chunk by chunk from the in-memory labels,
+        skipping the chunks which are only background. Missing chunks read
+        back as the fill value 0, so sparse labels create far fewer files.
+
+        Every write covers exactly one chunk, so they are independent and run
+        on a thread pool: compression and storage release the GIL.
+        """
+        chunks = tuple(min(c, s) for c, s in zip(chunks, level.shape))
+        za = group.create_dataset(
+            path, shape=level.shape, chunks=chunks, dtype=level.dtype, fill_value=0
+        )
+
+        def write_chunk(index: Tuple[int, ...]) -> None:
+            region = tuple(slice(i * c, (i + 1) * c) for i, c in zip(index, chunks))
+            block = level[region]
+            if block.any():
+                za[region] = block
 
+        grid = [-(-s // c) for s, c in zip(level.shape, chunks)]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # list() to re-raise any error from the workers
+            list(executor.map(write_chunk, np.ndindex(*grid)))
+
+    def _unpack_binim_yx(self, intarray: np.ndarray, h: int, w: int) -> np.ndarray:
+        """
+        Unpacks the bytes of a mask into a (h, w) boolean mask
+        """
+        binarray = self._UNPACK_LUT[intarray].reshape(-1)
+        # truncate and reshape
+        return np.reshape(binarray[: (w * h)], (h, w))
+
+    def _extract_shape(
+        self, mask: omero.model.Mask
+    ) -> Tuple[Tuple[int, ...], np.ndarray]:
+        """
+        :param mask MaskI: An OMERO mask
         :return: tuple of
-                - Binary mask
-                - (T, C, Z, Y, X, w, h) tuple of mask settings (T, C, Z may be
-                None)
+                - (T, C, Z, Y, X, h, w) tuple of mask settings, T, C, Z are -1
+                  if unset
+                - the packed mask bytes
+
+        Cached by mask ID since the same mask may be saved more than once,
+        e.g. when it is listed under several names of a label map
 
         TODO: Move to https://github.com/ome/omero-rois/
         """
+        key = unwrap(mask.id)
+        if key is not None and key in self._shape_cache:
+            return self._shape_cache[key]
 
-        t = unwrap(mask.theT)
-        c = unwrap(mask.theC)
-        z = unwrap(mask.theZ)
-
-        x = int(mask.x.val)
-        y = int(mask.y.val)
-        w = int(mask.width.val)
+        t, c, z = (unwrap(v) for v in (mask.theT, mask.theC, mask.theZ))
         h = int(mask.height.val)
+        w = int(mask.width.val)
+        shape_settings = (
+            -1 if t is None else t,
+            -1 if c is None else c,
+            -1 if z is None else z,
+            int(mask.y.val),
+            int(mask.x.val),
+            h,
+            w,
+        )
+        # Zero-copy view of only the bytes holding the h * w bits, so
+        # that no padding is unpacked or concatenated
+        intarray = np.frombuffer(mask.getBytes(), dtype=np.uint8)
+        extracted = (shape_settings, intarray[: -(-(h * w) // 8)])
+        if key is not None:
+            self._shape_cache[key] = extracted
+        return extracted
+
+    def clear_cache(self) -> None:
+        """
+        Drops the masks cached by _extract_shape
+        """
+        self._shape_cache.clear()
 
-        mask_packed = mask.getBytes()
-        # convert bytearray into something we can use
-        intarray = np.fromstring(mask_packed, dtype=np.uint8)
-        binarray = np.unpackbits(intarray).astype(self.dtype)
-        # truncate and reshape
-        binarray = np.reshape(binarray[: (w * h)], (h, w))
-
-        return binarray, (t, c, z, y, x, h, w)
+    def _extract_shape_arrays(self, masks: List[omero.model.Mask]) -> Dict[str, Any]:
+        """
+        Walks the masks once, unwrapping the settings of every shape.
 
-    def _get_indices(
-        self, ignored_dimensions: Set[str], d: str, d_value: int, d_size: int
-    ) -> List[int]:
+        :param masks [MaskI]: Iterable container of OMERO masks
+        :return: dict of arrays with one entry per shape:
+                - "T", "C", "Z": planes of the shape, -1 if unset
+                - "Y", "X", "H", "W": position and size of the shape
+                - "label": label value of the shape, i.e. ROI index + 1
+                - "packed": list of the packed mask bytes
+            as well as "colors", the fill color of each label
         """
-        Figures out which Z/C/T-planes a mask should be copied to
+        settings: List[Tuple[int, ...]] = []
+        packed: List[np.ndarray] = []
+        fill_colors: Dict[int, str] = {}
+        for count, shapes in enumerate(masks):
+            for mask in shapes:
+                # All shapes same color for each ROI
+                if mask.fillColor:
+                    fill_colors[count + 1] = unwrap(mask.fillColor)
+                shape_settings, intarray = self._extract_shape(mask)
+                settings.append(shape_settings + (count + 1,))
+                packed.append(intarray)
+
+        columns = np.array(settings, dtype=np.int64).reshape(-1, 8).T
+        shape_arrays: Dict[str, Any] = dict(zip("TCZYXHW", columns[:7]))
+        shape_arrays["label"] = columns[7]
+        shape_arrays["packed"] = packed
+        shape_arrays["colors"] = fill_colors
+        return shape_arrays
+
+    def _get_plane_ranges(
+        self, ignored_dimensions: Set[str], d: str, d_values: np.ndarray, d_size: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Figures out which Z/C/T-planes each mask should be copied to, as
+        arrays of (start, stop) plane indexes
         """
         if d in ignored_dimensions:
-            return [0]
-        if d_value is not None:
-            return [d_value]
-        return range(d_size)
+            return np.zeros_like(d_values), np.ones_like(d_values)
+        unset = d_values < 0
+        return (
+            np.where(unset, 0, d_values),
+            np.where(unset, d_size, d_values + 1),
+        )
+
+    def _check_masks_fit(
+        self, meta: np.ndarray, packed: List[np.ndarray], mask_shape: Tuple[int, ...]
+    ) -> None:
+        """
+        Raises if a mask would be painted outside of `mask_shape` or if it has
+        fewer packed bytes than needed for its h * w pixels
+        """
+        t0, t1, c0, c1, z0, z1, y, x, h, w, label = meta.T
+        starts = np.stack((t0, c0, z0, y, x, h, w))
+        stops = np.stack((t1, c1, z1, y + h, x + w))
+        limits = np.array(mask_shape)[:, None]
+        outside = (starts < 0).any(axis=0) | (stops > limits).any(axis=0)
+        too_short = np.array([p.size for p in packed]) < (h * w + 7) // 8
+        for invalid, reason in (
+            (outside, "is outside of the image"),
+            (too_short, "has fewer bytes than pixels"),
+        ):
+            if invalid.any():
+                raise Exception(f"Mask {label[invalid][0] - 1} {reason}")
 
     def masks_to_labels(
         self,
@@ -257,6 +489,7 @@ class MaskSaver:
         mask_shape: Tuple[int, ...],
         ignored_dimensions: Set[str] = None,
         check_overlaps: bool = True,
+        shape_arrays: Dict[str, Any] = None,
     ) -> Tuple[np.ndarray, Dict[int, str]]:
         """
         :param masks [MaskI]: Iterable container of OMERO masks
@@ -266,6 +499,8 @@ class MaskSaver:
             size to 1
         :param check_overlaps bool: Whether to check for overlapping masks or
             not
+        :param shape_arrays dict: `masks` as returned by
+            `_extract_shape_arrays`, if already extracted by the caller
         :return: Label image with size `mask_shape` as well as color metadata.
 
 
@@ -279,7 +514,26 @@ class MaskSaver:
         size_z: int = mask_shape[2]
         ignored_dimensions = ignored_dimensions or set()
 
-        labels = np.zeros(mask_shape, np.int64)
+        # The largest label is the number of ROIs. Without a dtype for the
+        # saver, use the smallest type that holds it.
+        nmasks = len(masks)
+        label_dtype = self.dtype
+        if label_dtype is None:
+            label_dtype = np.int32
+            if nmasks < 2 ** 8:
+                label_dtype = np.uint8
+            elif nmasks < 2 ** 16:
+                label_dtype = np.uint16
+        elif np.dtype(label_dtype) == np.bool_:
+            if nmasks > 1:
+                raise Exception(f"{nmasks} ROIs do not fit in a binary label")
+        elif nmasks > np.iinfo(label_dtype).max:
+            raise Exception(f"{nmasks} ROIs do not fit in {np.dtype(label_dtype)}")
+        print(f"Using {np.dtype(label_dtype)} labels")
+
+        # Paint into an in-memory buffer: the zarr arrays are only written once
+        # per pyramid level by save(), never mask by mask
+        labels = np.zeros(mask_shape, label_dtype)
 
         for d in "TCZYX":
             if d in ignored_dimensions:
@@ -290,35 +544,97 @@ class MaskSaver:
                 labels.shape == mask_shape
             ), f"Invalid label shape: {labels.shape}, expected {mask_shape}"
 
-        fillColors: Dict[int, str] = {}
-        for count, shapes in enumerate(masks):
-            # All shapes same color for each ROI
-            print(count)
-            for mask in shapes:
-                # Unused metadata: the{ZTC}, x, y, width, height, textValue
-                if mask.fillColor:
-                    fillColors[count + 1] = unwrap(mask.fillColor)
-                binim_yx, (t, c, z, y, x, h, w) = self._mask_to_binim_yx(mask)
-                for i_t in self._get_indices(ignored_dimensions, "T", t, size_t):
-                    for i_c in self._get_indices(ignored_dimensions, "C", c, size_c):
-                        for i_z in self._get_indices(
-                            ignored_dimensions, "Z", z, size_z
-                        ):
-                            if check_overlaps and np.any(
-                                np.logical_and(
-                                    labels[
-                                        i_t, i_c, i_z, y : (y + h), x : (x + w)
-                                    ].astype(np.bool),
-                                    binim_yx,
-                                )
-                            ):
-                                raise Exception(
-                                    f"Mask {count} overlaps with existing labels"
-                                )
-                            # ADD to the array, so zeros in our binarray don't
-                            # wipe out previous masks
-                            labels[i_t, i_c, i_z, y : (y + h), x : (x + w)] += (
-                                binim_yx * (count + 1)  # Prevent zeroing
-                            )
+        if shape_arrays is None:
+            shape_arrays = self._extract_shape_arrays(masks)
+        fillColors: Dict[int, str] = shape_arrays["colors"]
+        if not shape_arrays["packed"]:
+            return labels, fillColors
+
+        t0, t1 = self._get_plane_ranges(
+            ignored_dimensions, "T", shape_arrays["T"], size_t
+        )
+        c0, c1 = self._get_plane_ranges(
+            ignored_dimensions, "C", shape_arrays["C"], size_c
+        )
+        z0, z1 = self._get_plane_ranges(
+            ignored_dimensions, "Z", shape_arrays["Z"], size_z
+        )
+        # One row per mask of the (start, stop) planes and of the YX region
+        # to paint, shared by the numba and NumPy paths
+        meta = np.stack(
+            (
+                t0,
+                t1,
+                c0,
+                c1,
+                z0,
+                z1,
+                shape_arrays["Y"],
+                shape_arrays["X"],
+                shape_arrays["H"],
+                shape_arrays["W"],
+                shape_arrays["label"],
+            ),
+            axis=1,
+        )
+        packed = shape_arrays["packed"]
+        # The numba kernel does no bounds checks, so check both paths here
+        self._check_masks_fit(meta, packed, mask_shape)
+
+        if njit is not None:
+            kernel = _get_paint_kernel(labels.dtype)
+            self._paint_with_kernel(labels, meta, packed, check_overlaps, kernel)
+        else:
+            self._paint_with_numpy(labels, meta, packed, check_overlaps)
 
         return labels, fillColors
+
+    def _paint_with_kernel(
+        self,
+        labels: np.ndarray,
+        meta: np.ndarray,
+        packed: List[np.ndarray],
+        check_overlaps: bool,
+        kernel: Callable[..., int] = _paint_masks,
+    ) -> None:
+        """
+        Paints the masks described by `meta` with `kernel`, either the
+        compiled or the pure Python _paint_masks
+        """
+        offsets = np.cumsum([0] + [p.size for p in packed[:-1]], dtype=np.int64)
+        overlapping = kernel(
+            labels, np.concatenate(packed), offsets, meta, check_overlaps
+        )
+        if overlapping >= 0:
+            count = meta[overlapping, -1] - 1
+            raise Exception(f"Mask {count} overlaps with existing labels")
+
+    def _paint_with_numpy(
+        self,
+        labels: np.ndarray,
+        meta: np.ndarray,
+        packed: List[np.ndarray],
+        check_overlaps: bool,
+    ) -> None:
+        """
+        Paints the masks described by `meta` with NumPy, one mask at a time
+        """
+        # Planes which have been painted, a mask copied only to planes which
+        # have not been cannot overlap anything
+        touched = np.zeros(labels.shape[:3], dtype=bool)
+        # Plain ints make cheaper slice bounds than NumPy scalars
+        for intarray, region in zip(packed, meta.tolist()):
+            t_0, t_1, c_0, c_1, z_0, z_1, y, x, h, w, label = region
+            planes = (slice(t_0, t_1), slice(c_0, c_1), slice(z_0, z_1))
+            bin_bool = self._unpack_binim_yx(intarray, h, w)
+            # A single view over every plane the mask applies to, the
+            # 2D mask is broadcast over the leading T/C/Z axes
+            sub = labels[planes + (slice(y, y + h), slice(x, x + w))]
+            may_overlap = check_overlaps and touched[planes].any()
+            # Only the pixels under the mask, in every plane at once
+            if may_overlap and sub[..., bin_bool].any():
+                raise Exception(f"Mask {label - 1} overlaps with existing labels")
+            # Only set the pixels of the mask, so zeros in our binarray don't
+            # wipe out previous masks
+            sub[..., bin_bool] = label
+            touched[planes] = True
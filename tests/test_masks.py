@@ -0,0 +1,207 @@
+from typing import Callable, List, Tuple
+
+import numpy as np
+import pytest
+import zarr
+from omero_zarr.masks import MaskSaver, _get_paint_kernel, _paint_masks
+
+SHAPE = (2, 3, 4, 48, 40)
+
+
+class Image:
+    """Stand-in for an ImageWrapper, MaskSaver only reads its sizes"""
+
+    id = 1
+
+    def getSizeT(self) -> int:
+        return SHAPE[0]
+
+    def getSizeC(self) -> int:
+        return SHAPE[1]
+
+    def getSizeZ(self) -> int:
+        return SHAPE[2]
+
+    def getSizeY(self) -> int:
+        return SHAPE[3]
+
+    def getSizeX(self) -> int:
+        return SHAPE[4]
+
+
+def make_masks(
+    seed: int, count: int, overlapping: bool
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    Random packed masks in the (meta, packed) form used by the paint paths,
+    with T/C/Z either set or spanning every plane, sizes which are mostly
+    not a multiple of 8 pixels and some sparse masks with all-zero bytes
+    """
+    rng = np.random.default_rng(seed)
+    tiles = [(y, x) for y in range(0, SHAPE[3], 8) for x in range(0, SHAPE[4], 8)]
+    rng.shuffle(tiles)
+    meta = []
+    packed = []
+    for i in range(count):
+        h, w = (int(v) for v in rng.integers(1, 9, size=2))
+        if overlapping:
+            y = int(rng.integers(0, SHAPE[3] - h + 1))
+            x = int(rng.integers(0, SHAPE[4] - w + 1))
+        else:
+            y, x = tiles[i]
+        planes = []
+        for size in SHAPE[:3]:
+            if rng.random() < 0.5:
+                planes.extend((0, size))
+            else:
+                d = int(rng.integers(size))
+                planes.extend((d, d + 1))
+        meta.append((*planes, y, x, h, w, i + 1))
+        bits = rng.random(h * w) < rng.choice((0.1, 0.6))
+        packed.append(np.packbits(bits))
+    return np.array(meta, dtype=np.int64), packed
+
+
+def paint_both(
+    meta: np.ndarray,
+    packed: List[np.ndarray],
+    check_overlaps: bool,
+    kernel: Callable[..., int] = _paint_masks,
+    dtype: str = "uint8",
+) -> Tuple[np.ndarray, np.ndarray]:
+    saver = MaskSaver(Image())
+    with_kernel = np.zeros(SHAPE, dtype)
+    saver._paint_with_kernel(with_kernel, meta, packed, check_overlaps, kernel)
+    with_numpy = np.zeros(SHAPE, dtype)
+    saver._paint_with_numpy(with_numpy, meta, packed, check_overlaps)
+    return with_kernel, with_numpy
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_paint_parity(seed: int) -> None:
+    meta, packed = make_masks(seed, 20, overlapping=False)
+    with_kernel, with_numpy = paint_both(meta, packed, check_overlaps=True)
+    assert with_kernel.any()
+    assert np.array_equal(with_kernel, with_numpy)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_paint_parity_unchecked_overlaps(seed: int) -> None:
+    meta, packed = make_masks(seed, 40, overlapping=True)
+    with_kernel, with_numpy = paint_both(meta, packed, check_overlaps=False)
+    assert np.array_equal(with_kernel, with_numpy)
+
+
+def make_overlap() -> Tuple[np.ndarray, List[np.ndarray]]:
+    meta, packed = make_masks(0, 2, overlapping=False)
+    # Second mask on top of the first one, on every plane
+    meta[1, :8] = (0, SHAPE[0], 0, SHAPE[1], 0, SHAPE[2], meta[0, 6], meta[0, 7])
+    meta[1, 8:10] = 1
+    packed[1] = np.array([0xFF], dtype=np.uint8)
+    packed[0][0] |= 0x80
+    return meta, packed
+
+
+def test_paint_overlap() -> None:
+    meta, packed = make_overlap()
+    saver = MaskSaver(Image())
+    for paint in (saver._paint_with_kernel, saver._paint_with_numpy):
+        labels = np.zeros(SHAPE, np.uint8)
+        with pytest.raises(Exception, match="Mask 1 overlaps"):
+            paint(labels, meta, packed, True)
+
+
+# The label dtypes masks_to_labels picks by default or for --label-bits
+@pytest.mark.parametrize(
+    "dtype", ["uint8", "uint16", "int32", "bool", "int8", "int16", "int64"]
+)
+def test_compiled_kernel(dtype: str) -> None:
+    pytest.importorskip("numba")
+    kernel = _get_paint_kernel(np.dtype(dtype))
+    for seed in range(3):
+        meta, packed = make_masks(seed, 20, overlapping=False)
+        with_kernel, with_numpy = paint_both(meta, packed, True, kernel, dtype)
+        assert with_kernel.any()
+        assert np.array_equal(with_kernel, with_numpy)
+        meta, packed = make_masks(seed, 40, overlapping=True)
+        with_kernel, with_numpy = paint_both(meta, packed, False, kernel, dtype)
+        assert np.array_equal(with_kernel, with_numpy)
+    meta, packed = make_overlap()
+    labels = np.zeros(SHAPE, dtype)
+    with pytest.raises(Exception, match="Mask 1 overlaps"):
+        MaskSaver(Image())._paint_with_kernel(labels, meta, packed, True, kernel)
+
+
+@pytest.mark.parametrize(
+    "column,value",
+    [
+        (1, SHAPE[0] + 1),
+        (3, SHAPE[1] + 1),
+        (4, -1),
+        (6, -1),
+        (6, SHAPE[3]),
+        (7, SHAPE[4]),
+    ],
+)
+def test_mask_outside(column: int, value: int) -> None:
+    meta, packed = make_masks(0, 3, overlapping=False)
+    saver = MaskSaver(Image())
+    saver._check_masks_fit(meta, packed, SHAPE)
+    meta[2, column] = value
+    with pytest.raises(Exception, match="Mask 2 is outside"):
+        saver._check_masks_fit(meta, packed, SHAPE)
+
+
+def test_mask_too_short() -> None:
+    meta, packed = make_masks(0, 3, overlapping=False)
+    meta[2, 8:10] = (3, 3)
+    packed[2] = np.zeros(1, dtype=np.uint8)
+    with pytest.raises(Exception, match="Mask 2 has fewer bytes"):
+        MaskSaver(Image())._check_masks_fit(meta, packed, SHAPE)
+
+
+def label_dtype(count: int, dtype: str = None) -> np.dtype:
+    """Dtype of the labels painted from `count` ROIs, without any pixels"""
+    saver = MaskSaver(Image(), dtype)
+    shape_arrays = {"packed": [], "colors": {}}
+    labels, _ = saver.masks_to_labels(
+        [None] * count, (1, 1, 1, 4, 4), shape_arrays=shape_arrays
+    )
+    return labels.dtype
+
+
+@pytest.mark.parametrize(
+    "count,dtype",
+    [
+        (1, "uint8"),
+        (255, "uint8"),
+        (256, "uint16"),
+        (65535, "uint16"),
+        (65536, "int32"),
+    ],
+)
+def test_default_label_dtype(count: int, dtype: str) -> None:
+    assert label_dtype(count) == np.dtype(dtype)
+
+
+def test_explicit_label_dtype() -> None:
+    assert label_dtype(127, "int8") == np.dtype("int8")
+    with pytest.raises(Exception, match="128 ROIs do not fit in int8"):
+        label_dtype(128, "int8")
+    assert label_dtype(1, "bool") == np.dtype("bool")
+    with pytest.raises(Exception, match="2 ROIs do not fit in a binary label"):
+        label_dtype(2, "bool")
+
+
+def test_write_level() -> None:
+    rng = np.random.default_rng(0)
+    # Neither 40 nor 36 is a multiple of the chunk size
+    level = rng.integers(1, 5, size=(1, 2, 1, 40, 36), dtype=np.uint8)
+    level[0, 1, 0, 16:32, 16:32] = 0
+    group = zarr.group()
+    MaskSaver(Image())._write_level(group, "0", level, (1, 1, 1, 16, 16))
+    za = group["0"]
+    assert za.chunks == (1, 1, 1, 16, 16)
+    assert np.array_equal(za[:], level)
+    assert "0/0.0.0.1.1" in group.store
+    assert "0/0.1.0.1.1" not in group.store